@@ -1,8 +1,24 @@
 #!/usr/bin/env python3
 import sys
 
-import requests
-import argparse
+_json_loads = None
+_json_dumps = None
+
+
+def _setup_json():
+    "Bind the fastest available JSON codec; deferred off the startup path"
+    global _json_loads, _json_dumps
+    try:
+        # C-implemented parser, noticeably faster on multi-output payloads
+        import orjson
+        _json_loads = orjson.loads
+        _json_dumps = orjson.dumps
+    except ImportError:
+        import json
+        _json_loads = json.loads
+
+        def _json_dumps(obj):
+            return json.dumps(obj).encode()
 
 
 class IcingaOutput:
@@ -17,10 +33,14 @@ class IcingaOutput:
         self._result = self.OK
         self._perfdata = dict()
 
-    def __lshift__(self, s):
-        assert type(s) == str
+    def __lshift__(self, s: str) -> None:
         self._retv.append(s)
 
+    def message(self):
+        if len(self._retv) == 1:
+            return self._retv[0]
+        return ''.join(self._retv)
+
     def set_perfdata(self, k, v):
         self._perfdata[k] = v
 
@@ -28,25 +48,31 @@ class IcingaOutput:
         self._debug_data.append(s)
 
     def flush(self, verbose=False):
+        import os
+
+        parts = []
         if self._result == self.CRITICAL:
-            print('ERROR - ', end='')
+            parts.append('ERROR - ')
         elif self._result == self.WARNING:
-            print('WARNING - ', end='')
-        print(''.join(self._retv), end='')
+            parts.append('WARNING - ')
+        parts.extend(self._retv)
 
         # do not append perfdata when in UKNOWN in order not to break graphs
-        if self._result != self.UNKNOWN:
-            if self._perfdata:
-                print('|', end='')
-                for k, v in self._perfdata.items():
-                    print(f"{k}={v}", end=' ')
-        #
-        print('')
+        if self._result != self.UNKNOWN and self._perfdata:
+            parts.append('|')
+            parts.append(' '.join(
+                f"{k}={v}" for k, v in self._perfdata.items()))
+        parts.append('\n')
+        # single write syscall for the whole plugin line
+        sys.stdout.flush()
+        os.write(1, ''.join(parts).encode())
         # add verbose debug dat
-        if verbose:
-            for ln in self._debug_data:
-                sys.stderr.write(f'{ln}\n')
-        raise SystemExit(self._result)
+        if verbose and self._debug_data:
+            sys.stderr.flush()
+            os.write(2, ('\n'.join(
+                str(ln) for ln in self._debug_data) + '\n').encode())
+        # the process owns no cleanup hooks; skip interpreter teardown
+        os._exit(self._result)
 
     def error(self):
         if self._result in [IcingaOutput.OK, IcingaOutput.WARNING]:
@@ -58,28 +84,50 @@ class IcingaOutput:
 
 class NetioJson:
     def __init__(self, args):
+        # deferred so --help and argparse error paths never pay for the
+        # requests/urllib3 import chain
+        import requests
+        from requests.adapters import HTTPAdapter
+        if _json_loads is None:
+            _setup_json()
+
         self.args = args
         self._url = f'http://{args.address}:{args.port}/netio.json'
+        # single keep-alive connection, reused for the GET->POST pair
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=4, max_retries=0))
+        if args.auth_user:
+            self._session.auth = (args.auth_user, args.auth_password)
+        self._timeout = (2, args.timeout)  # (connect, read)
+        self._status_cache = None
 
     def _getStatus(self):
-        http_params = dict()
-        if args.auth_user:
-            http_params['auth'] = (args.auth_user, args.auth_password)
-        result = requests.get(self._url, **http_params)
-        assert result.status_code == 200
-        return result.json()
+        if self._status_cache is None:
+            result = self._session.get(self._url, timeout=self._timeout)
+            assert result.status_code == 200
+            self._status_cache = _json_loads(result.content)
+        return self._status_cache
+
+    def _invalidate(self):
+        "Force a fresh GET on the next _getStatus call"
+        self._status_cache = None
+
+    def _outputs_by_id(self, data):
+        "Index the Outputs array by stringified ID for O(1) lookup"
+        return {str(o["ID"]): o for o in data["Outputs"]}
 
     def _postCommand(self, command):
-        http_params = dict()
-        if args.auth_user:
-            http_params['auth'] = (args.auth_user, args.auth_password)
-        result = requests.post(self._url, json=command, **http_params)
+        result = self._session.post(
+            self._url, data=_json_dumps(command),
+            headers={'Content-Type': 'application/json'},
+            timeout=self._timeout)
         if result.status_code == 401:
             sys.stderr.write(
                 "ERROR 401  - Authorization failed during JSON POST\n")
             raise SystemExit(3)
         assert result.status_code == 200, result.status_code
-        return result.json()
+        return _json_loads(result.content)
 
     def info(self):
         "Get device info"
@@ -92,11 +140,11 @@ class NetioJson:
         name = data['Agent']['DeviceName']
         sn = data['Agent']['SerialNumber']
 
-        if 'expect_mac' in self.args:
-            if self.args.expect_mac.lower() != mac.lower():
-                output << f"Device {name}, with {mac}, expected {self.args.expect_mac}"
-                output.error()
-                return output
+        expect_mac = getattr(self.args, 'expect_mac', None)
+        if expect_mac is not None and expect_mac.lower() != mac.lower():
+            output << f"Device {name}, with {mac}, expected {expect_mac}"
+            output.error()
+            return output
         output << f"Device {name}, (model: {model}, S/N: {sn}, MAC {mac})"
         return output
 
@@ -106,15 +154,16 @@ class NetioJson:
         data = self._getStatus()
         output.add_debug_data(str(data))
 
+        args = self.args
         uptime = int(data['Agent']['Uptime'])
         name = data['Agent']['DeviceName']
         output.set_perfdata('uptime', f'{uptime}s')
 
-        if self.args.min is not None and uptime < self.args.min:
-            output << f"Uptime {uptime}s is lower than expected {self.args.min}s"
+        if args.min is not None and uptime < args.min:
+            output << f"Uptime {uptime}s is lower than expected {args.min}s"
             output.error()
-        elif self.args.max is not None and uptime > self.args.max:
-            output << f"Uptime {uptime}s is larger than expected {self.args.max}s"
+        elif args.max is not None and uptime > args.max:
+            output << f"Uptime {uptime}s is larger than expected {args.max}s"
             output.error()
         else:
             output << f"Device {name} - uptime is {uptime}s1"
@@ -129,13 +178,13 @@ class NetioJson:
         uptime = int(data['Agent']['Uptime'])
         output.set_perfdata('uptime', f'{uptime}s')
 
+        args = self.args
         output_id = str(args.output_id)
-        output_state = [k for k in data['Outputs'] if str(k["ID"]) == output_id]
-        if len(output_state) != 1:
+        output_state = self._outputs_by_id(data).get(output_id)
+        if output_state is None:
             output << f"ERROR - Unable to find output ID '{args.output_id}'"
             output.unknown()
             return output
-        output_state = output_state[0]
         output_power_state = output_state['State']
         output_name = output_state['Name']
         output.set_perfdata('state', int(output_power_state))
@@ -146,20 +195,23 @@ class NetioJson:
         output.set_perfdata('load', f'{load}W')
         output.set_perfdata('power_factor', float(output_state['PowerFactor']))
         #
+        state_msg = \
+            f"Output {output_id}({output_name}) state is {output_power_state}"
         if args.expected_state is not None:
             output.add_debug_data(output_state)
-            if output_power_state != int(args.expected_state):
-                expected_state = int(args.expected_state)
-                output << f"Output {output_id}({output_name}) state is {output_power_state}, should be {expected_state}"
+            expected_state = int(args.expected_state)
+            if output_power_state != expected_state:
+                output << f"{state_msg}, should be {expected_state}"
                 output.error()
             else:
-                output << f"Output {output_id}({output_name}) state is {output_power_state}"
+                output << state_msg
         else:
-            output << f"Output {output_id}({output_name}) state is {output_power_state}"
+            output << state_msg
         return output
 
     def check_output_load(self):
         "Check socket load"
+        import operator
         output = IcingaOutput()
         data = self._getStatus()
         output.add_debug_data(str(data))
@@ -167,13 +219,13 @@ class NetioJson:
         uptime = int(data['Agent']['Uptime'])
         output.set_perfdata('uptime', f'{uptime}s')
 
+        args = self.args
         output_id = str(args.output_id)
-        output_state = [k for k in data['Outputs'] if str(k["ID"]) == output_id]
-        if len(output_state) != 1:
+        output_state = self._outputs_by_id(data).get(output_id)
+        if output_state is None:
             output << f"ERROR - Unable to find output ID '{args.output_id}'"
             output.unknown()
             return output
-        output_state = output_state[0]
         output_power_state = output_state['State']
         output_name = output_state['Name']
         output.set_perfdata('state', int(output_power_state))
@@ -185,18 +237,16 @@ class NetioJson:
         output.set_perfdata('power_factor', float(output_state['PowerFactor']))
         #
         output << f"Output {output_id}({output_name}) load {current}A, {load}W"
-        if args.min_watts is not None and load < args.min_watts:
-            output << f', that is lower than {args.min_watts}W'
-            output.error()
-        elif args.max_watts is not None and load > args.max_watts:
-            output << f', that is greater than {args.max_watts}W'
-            output.error()
-        elif args.min_amps is not None and current > args.min_amps:
-            output << f', that is lower than {args.min_amps}A'
-            output.error()
-        elif args.max_amps is not None and current > args.max_amps:
-            output << f', that is greater than {args.max_amps}A'
-            output.error()
+        checks = (
+            ('lower', load, args.min_watts, 'W', operator.lt),
+            ('greater', load, args.max_watts, 'W', operator.gt),
+            ('lower', current, args.min_amps, 'A', operator.lt),
+            ('greater', current, args.max_amps, 'A', operator.gt),
+        )
+        for word, value, threshold, unit, op in checks:
+            if threshold is not None and op(value, threshold):
+                output << f', that is {word} than {threshold}{unit}'
+                output.error()
         return output
 
     def set_output(self):
@@ -205,13 +255,13 @@ class NetioJson:
         data = self._getStatus()
         output.add_debug_data(str(data))
 
+        args = self.args
         output_id = str(args.output_id)
-        output_state = [k for k in data['Outputs'] if str(k["ID"]) == output_id]
-        if len(output_state) != 1:
+        output_state = self._outputs_by_id(data).get(output_id)
+        if output_state is None:
             output << f"ERROR - Unable to find output ID '{args.output_id}'"
             output.unknown()
             return output
-        output_state = output_state[0]
         output_power_state = output_state['State']
         output.set_perfdata('old_state', int(output_power_state))
         #
@@ -232,13 +282,15 @@ class NetioJson:
                 dict(ID=int(output_id), Action=action_id)
             ])
         data = self._postCommand(command=command)
+        # the POST already returns the post-mutation state; keep it so any
+        # follow-up read does not need a second GET
+        self._status_cache = data
         #
-        output_state = [k for k in data['Outputs'] if str(k["ID"]) == output_id]
-        if len(output_state) != 1:
+        output_state = self._outputs_by_id(data).get(output_id)
+        if output_state is None:
             output << f"ERROR - Unable to find output ID '{args.output_id}'"
             output.unknown()
             return output
-        output_state = output_state[0]
         output_power_state = output_state['State']
         output.set_perfdata('new_state', int(output_power_state))
 
@@ -247,9 +299,9 @@ class NetioJson:
 
 
 def makeParser():
+    import argparse
     parser = argparse.ArgumentParser(description='Check Netio PDU status')
     parser.add_argument('--address', '-H', default='192.168.50.220',
-                        nargs=1,
                         help='Specify IP address of the device')
     parser.add_argument('--port', '-p', default=80,
                         help='JSON port (default: 80)')
@@ -257,25 +309,66 @@ def makeParser():
                         help='Username used to access the console')
     parser.add_argument('--password', '-K', default='', dest='auth_password',
                         help='Password  used to access the console')
+    parser.add_argument('--timeout', '-t', default=5, type=float,
+                        help='HTTP read timeout in seconds (default: 5)')
+    parser.add_argument('--batch', default=None, metavar='FILE',
+                        help='Read device addresses from FILE (one per '
+                             'line) and check them all concurrently')
     parser.add_argument('--verbose', '-v', default=0,
                         action='store_const', const=1,
                         dest='verbose', help='Be verbose')
-    parser.set_defaults(action=NetioJson.info)
+    subparsers = parser.add_subparsers(dest='command',
+                                       help="Select sub-command")
+
+    # build only the subparser the command line actually names; the full
+    # set is constructed just for the help and error paths
+    builders = {
+        'info': _build_info,
+        'uptime': _build_uptime,
+        'output': _build_output,
+        'load': _build_load,
+        'set_output': _build_set_output,
+    }
+    # skip the values of value-taking options so e.g. a password or
+    # batch filename named like a subcommand cannot select its builder
+    value_opts = {'-H', '--address', '-p', '--port', '-k', '--user',
+                  '-K', '--password', '-t', '--timeout', '--batch'}
+    chosen = None
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        token = argv[i]
+        if token in value_opts:
+            i += 2
+            continue
+        if token in builders:
+            chosen = token
+            break
+        i += 1
+    if chosen:
+        builders[chosen](subparsers)
+    else:
+        for build in builders.values():
+            build(subparsers)
+
+    return parser
 
-    subparsers = parser.add_subparsers(help="Select sub-command")
 
+def _build_info(subparsers):
     info = subparsers.add_parser('info', help='Get PDU info')
     info.add_argument("--expect-mac", "--mac", default=None, nargs="?",
                       help="Expect MAC address")
-    info.set_defaults(action=NetioJson.info)
 
+
+def _build_uptime(subparsers):
     uptime = subparsers.add_parser('uptime', help='Check PDU uptime')
     uptime.add_argument("--min", nargs="?", type=int,
                         help="Minimum expected uptime in seconds")
     uptime.add_argument("--max", nargs="?", type=int,
                         help="Maximum expected uptime in seconds")
-    uptime.set_defaults(action=NetioJson.uptime)
 
+
+def _build_output(subparsers):
     check_output = subparsers.add_parser('output', help='Check output state')
     check_output.add_argument("--output_id", '-n', dest='output_id',
                               default=1,
@@ -288,8 +381,9 @@ def makeParser():
                               dest='expected_state',
                               default=None,
                               help="Expect output to be powered off")
-    check_output.set_defaults(action=NetioJson.check_output_state)
 
+
+def _build_load(subparsers):
     load = subparsers.add_parser('load', help='Check output load')
     load.add_argument("--output_id", '-n', dest='output_id',
                       default=1,
@@ -306,8 +400,9 @@ def makeParser():
     load.add_argument("--max-amps", action='store', dest='max_amps',
                       default=None, type=float,
                       help="Expect maximum load in A")
-    load.set_defaults(action=NetioJson.check_output_load)
 
+
+def _build_set_output(subparsers):
     set_output = subparsers.add_parser('set_output', help='Set output state')
     set_output.add_argument("--output_id", '-n', dest='output_id',
                             required=True,
@@ -332,18 +427,90 @@ def makeParser():
                             action='store_const', const='toggle',
                             default=None,
                             help="Toggle the power state")
-    set_output.set_defaults(action=NetioJson.set_output)
 
-    return parser
+
+# flat subcommand -> method dispatch; no subcommand behaves like 'info'
+ACTIONS = {
+    None: NetioJson.info,
+    'info': NetioJson.info,
+    'uptime': NetioJson.uptime,
+    'output': NetioJson.check_output_state,
+    'load': NetioJson.check_output_load,
+    'set_output': NetioJson.set_output,
+}
+
+
+def run_check(action, device):
+    "Run a check, turning an unreachable device into an UNKNOWN result"
+    import requests  # already loaded by NetioJson.__init__, cheap here
+    try:
+        return action(device)
+    except requests.RequestException as e:
+        output = IcingaOutput()
+        output.unknown()
+        output << f"Timeout contacting {device._url}: {e}"
+        return output
+
+
+def run_batch(args):
+    "Run the selected check against many devices concurrently"
+    import argparse
+    from concurrent.futures import ThreadPoolExecutor
+
+    with open(args.batch) as f:
+        addresses = [ln for ln in (raw.strip() for raw in f)
+                     if ln and not ln.startswith('#')]
+    action = ACTIONS.get(args.command)
+    if not action or not addresses:
+        print(f"UNKNOWN - nothing to check in batch file '{args.batch}'")
+        raise SystemExit(3)
+
+    def check_one(address):
+        device_args = argparse.Namespace(**vars(args))
+        device_args.address = address
+        # one broken PDU must never abort the whole batch: turn any
+        # per-device failure (bad status asserts, the SystemExit raised
+        # on 401, ...) into an UNKNOWN result for that device only
+        try:
+            return run_check(action, NetioJson(device_args))
+        except SystemExit as e:
+            output = IcingaOutput()
+            output.unknown()
+            output << f"check exited with status {e.code}"
+            return output
+        except Exception as e:
+            output = IcingaOutput()
+            output.unknown()
+            output << f"check failed: {e!r}"
+            return output
+
+    # the run is network-bound: one thread per device, wall clock is
+    # bounded by the slowest PDU instead of the sum
+    with ThreadPoolExecutor(max_workers=min(32, len(addresses))) as pool:
+        results = list(pool.map(check_one, addresses))
+
+    worst = max(r._result for r in results)
+    if worst == IcingaOutput.OK:
+        print(f"{len(addresses)} devices checked")
+    else:
+        failed = [f"{addr}: {r.message()}"
+                  for addr, r in zip(addresses, results)
+                  if r._result != IcingaOutput.OK]
+        print(f"{len(failed)}/{len(addresses)} devices failed - "
+              + '; '.join(failed))
+    raise SystemExit(worst)
 
 
 def main(args):
+    if args.batch:
+        run_batch(args)
     device = NetioJson(args)
-    if args.action:
-        result = args.action(self=device)
+    action = ACTIONS.get(args.command)
+    if action:
+        result = run_check(action, device)
         result.flush(verbose=args.verbose)
     else:
-        print(f"UNKNOWN - action {args.action} is not implemented")
+        print(f"UNKNOWN - action {args.command} is not implemented")
         raise SystemExit(3)
 
 